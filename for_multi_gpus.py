@@ -22,8 +22,9 @@ class CasualSelfAttention(nn.Module):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         # not really a 'bias', more of a mask, but following the OpenAI/HF naming through
+        # non-persistent: rebuilt at construction, not written into every checkpoint (12 layers x 4MB)
         self.register_buffer("bias", torch.tril(torch.ones(config.block_size,
-         config.block_size)).view(1, 1,config.block_size, config.block_size))
+         config.block_size)).view(1, 1,config.block_size, config.block_size), persistent=False)
         
     def forward(self, x):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
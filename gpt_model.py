@@ -1,11 +1,12 @@
 from dataclasses import dataclass
-import inspect
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
 import math
 import time
 import os
+import contextlib
 
 # ------------------------------------------------------------------------------------------
 
@@ -21,46 +22,53 @@ class CasualSelfAttention(nn.Module):
         # regularization
         self.n_head = config.n_head
         self.n_embd = config.n_embd
-        # not really a 'bias', more of a mask, but following the OpenAI/HF naming through
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size,
-         config.block_size)).view(1, 1,config.block_size, config.block_size))
+        # no causal mask buffer ('bias' in OpenAI/HF naming): SDPA with is_causal=True builds the mask inside the kernel
         
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
+        # past_kv: (k, v) of the previous positions, x then only holds the new token
+        # use_cache: also return the (k, v) of all positions so far, for the next generation step
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
         # calculate query, key, values for all heads in batch and move head forward to br the batch dim
         # nh is "number pf heads", he is "head size", and C (number of channels) = nh * hs
         # e,g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs = c = 768 channels in the Transformer
-        qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1))) # (B, nh, T, hs)
-
-        # attention (materializes thhe large (T, T) matrix for all the queries and keys)
-        # att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
-        # att = F.softmax(att, dim=-1)
-        # y = att @ v # (B, nh, T, T) * (B, nh, T, hs) -> (B, nh, T, hs)
+        qkv = self.c_attn(x) # (B, T, 3 * C)
+        # one view + one permute into the interleaved (3, B, nh, T, hs) layout instead of three split/view/transpose
+        qkv = qkv.view(B, T, 3, self.n_head, C // self.n_head).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv.unbind(0) # each (B, nh, T, hs)
+        if past_kv is not None:
+            assert T == 1, "with a kv cache only the newest token is forwarded"
+            past_k, past_v = past_kv
+            k = torch.cat((past_k, k), dim=2) # (B, nh, T_past + 1, hs)
+            v = torch.cat((past_v, v), dim=2)
 
         # Flash attention (does not materialize the large (T, T) matrix for all the queries and keys)
-        y = F.scaled_dot_product_attention(q, k, v, is_causal=True)
-
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
+        # on CUDA pin SDPA to the FlashAttention-2 kernel, with the memory-efficient kernel as the fallback for
+        # fp32 inputs and pre-sm80 GPUs (no flash kernel there); CPU and MPS keep SDPA's own backend choice
+        # a single new query may attend to every cached position, so it needs no causal mask
+        sdpa_ctx = sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]) if q.is_cuda else contextlib.nullcontext()
+        with sdpa_ctx:
+            y = F.scaled_dot_product_attention(q, k, v, is_causal=past_kv is None)
+
+        # q, k, v are (B, nh, T, hs) views of the (B, T, nh, hs) memory from c_attn, and the flash kernel returns y
+        # in that same BSHD memory layout, so after the transpose reshape is a free view instead of a full copy
+        y = y.transpose(1, 2).reshape(B, T, C) # re-assemble all head outputs side by side
         # output projection                     
         y = self.c_proj(y)
+        if use_cache:
+            return y, (k, v)
         return y
     
 class MLP(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
-        self.gelu = nn.GELU() # gelu non-linear activation function
+        self.gelu = nn.GELU(approximate='tanh') # gelu non-linear activation function, tanh approximation as in the original GPT-2
         self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
         self.c_proj.NANOGPT_SCALE_INIT = 1
 
     def forward(self, x):
-        x = self.c_fc(x)
-        x = self.gelu(x)
+        # under torch.compile the bias add + gelu is fused into the c_fc matmul epilogue (check with TORCH_LOGS="output_code")
+        x = self.gelu(self.c_fc(x))
         x = self.c_proj(x)
         return x
 
@@ -72,11 +80,62 @@ class Block(nn.Module):
         self.ln_2 = nn.LayerNorm(config.n_embd)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x)) # Residual connection:  attention is a communication operation it is where all thr 1024 tokens lined up in a sequence and this is where the tokens communicate, this is where they talk to each other and exchange information so attention is aggergation function, pooling function it's a weighted sum function and it is a reduced operation
+    def forward(self, x, past_kv=None, use_cache=False):
+        attn_out = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=use_cache)
+        if use_cache:
+            attn_out, present_kv = attn_out
+        x = x + attn_out # Residual connection:  attention is a communication operation it is where all thr 1024 tokens lined up in a sequence and this is where the tokens communicate, this is where they talk to each other and exchange information so attention is aggergation function, pooling function it's a weighted sum function and it is a reduced operation
         x = x + self.mlp(self.ln_2(x)) # Map connection:  MLP is a feedforward neural network it is a non-linear function, it is a transformation function. It happens every single token individually, there is no information being collected or exchanges between the tokens, so the attention is reduced and mlp is the map 
+        if use_cache:
+            return x, present_kv
         return x
 
+class FusedLinearCrossEntropy(torch.autograd.Function):
+    # cross entropy of the classifier logits (x @ weight.T) computed tile by tile along the vocab dimension,
+    # the full (B*T, vocab_size) logits tensor is never materialized, backward recomputes each tile
+    # x: (N, C), weight: (vocab_size, C), targets: (N,) int64, positions with target -100 are ignored
+
+    @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda')
+    def forward(ctx, x, weight, targets, tile_size):
+        N, V = x.size(0), weight.size(0)
+        lse = torch.full((N,), float('-inf'), dtype=torch.float32, device=x.device) # running logsumexp over the tiles
+        target_logit = torch.zeros(N, dtype=torch.float32, device=x.device)
+        valid = targets != -100
+        for start in range(0, V, tile_size):
+            end = min(start + tile_size, V)
+            logits = (x @ weight[start:end].t()).float() # (N, tile_size)
+            lse = torch.logaddexp(lse, torch.logsumexp(logits, dim=-1))
+            in_tile = (targets >= start) & (targets < end)
+            idx = (targets - start).clamp(0, end - start - 1).unsqueeze(1)
+            target_logit += torch.where(in_tile, logits.gather(1, idx).squeeze(1), 0.0)
+        ctx.save_for_backward(x, weight, targets, lse, valid)
+        ctx.tile_size = tile_size
+        # mean over the valid positions only, same as F.cross_entropy(ignore_index=-100)
+        return torch.where(valid, lse - target_logit, 0.0).sum() / valid.sum().clamp_min(1)
+
+    @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
+    def backward(ctx, grad_output):
+        x, weight, targets, lse, valid = ctx.saved_tensors
+        V = weight.size(0)
+        # ignored positions get zero gradient, valid ones are scaled by 1 / num_valid (the mean)
+        row_scale = (valid.float() * (grad_output / valid.sum().clamp_min(1))).unsqueeze(1)
+        grad_x = torch.zeros(x.shape, dtype=torch.float32, device=x.device)
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device)
+        for start in range(0, V, ctx.tile_size):
+            end = min(start + ctx.tile_size, V)
+            logits = (x @ weight[start:end].t()).float()
+            # d loss / d logits = (softmax - one_hot(targets)) / num_valid
+            grad_logits = torch.exp(logits - lse.unsqueeze(1))
+            in_tile = (targets >= start) & (targets < end)
+            idx = (targets - start).clamp(0, end - start - 1).unsqueeze(1)
+            grad_logits.scatter_add_(1, idx, -in_tile.float().unsqueeze(1))
+            grad_logits *= row_scale
+            grad_x += grad_logits @ weight[start:end]
+            grad_weight[start:end] = grad_logits.t() @ x
+        return grad_x.to(x.dtype), grad_weight.to(weight.dtype), None, None
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024 # max sequence length
@@ -93,18 +152,21 @@ class GPT(nn.Module):
         self.transformer = nn.ModuleDict(dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.Sequential(*[Block(config) for _ in range(config.n_layer)]), # same h.0, h.1, ... keys as a ModuleList
             ln_f = nn.LayerNorm(config.n_embd),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)  
 
-        # weigth sharing scheme
-        self.transformer.wte.weight = self.lm_head.weight # it basically copies the data pointer and it copies the reference
-
         # init params
         self.apply(self._init_weights)
 
+        # weigth sharing scheme, done after the init so nothing re-initializes one side of the shared tensor
+        self.lm_head.weight = self.transformer.wte.weight # it basically copies the data pointer and it copies the reference
+        assert self.transformer.wte.weight.data_ptr() == self.lm_head.weight.data_ptr(), "wte and lm_head must share their weight"
+
     def _init_weights(self, module):
+        if module is self.lm_head:
+            return # its weight is tied to wte, which is initialized as an Embedding
         if isinstance(module, nn.Linear):
             std = 0.02
             if hasattr(module, 'NANOGPT_SCALE_INIT'):
@@ -116,24 +178,42 @@ class GPT(nn.Module):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
         
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, last_token_only=False, past_kv=None, use_cache=False):
         # idx is of shape (B, T) where B is batch size and T is the sequence length
+        # last_token_only: only project the final position to logits, all sampling needs
+        # past_kv / use_cache: kv cache for generation, a list with the (k, v) of every layer,
+        # with use_cache=True the updated cache is returned as a third output
         B, T = idx.size()
-        assert T <= self.config.block_size, f"Cannot forward sequence lenght {T}, block size is {self.config.block_size}"
+        past_len = past_kv[0][0].size(2) if past_kv is not None else 0
+        assert past_len + T <= self.config.block_size, f"Cannot forward sequence lenght {past_len + T}, block size is {self.config.block_size}"
         # forward the GPT model tokens and position embeddings
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
+        pos = torch.arange(past_len, past_len + T, dtype=torch.long, device=idx.device) # shape (T)
         pos_emb = self.transformer.wpe(pos) # postion embedding of shape (T, n_embd)
         tok_emb = self.transformer.wte(idx) # token embedding of shape (B, T, n_embd)
         x = tok_emb + pos_emb # sum token and position embedding
         # forward the block of the transformer
-        for block in self.transformer.h:
-            x = block(x)
+        if use_cache:
+            # generation threads the kv cache of every layer, so the blocks are stepped one by one
+            present_kv = []
+            for i, block in enumerate(self.transformer.h):
+                x, kv = block(x, past_kv=past_kv[i] if past_kv is not None else None, use_cache=True)
+                present_kv.append(kv)
+        else:
+            x = self.transformer.h(x) # a single call chain that torch.compile can trace without a Python loop
         # forward the final layernorm and the classifier
         x = self.transformer.ln_f(x) 
-        logits = self.lm_head(x) # (B, T, vocab_size)
+        logits = None
         loss = None
         if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            # fused classifier + loss in vocab tiles of 8192, the (B*T, vocab_size) logits are never stored
+            # targets are int32 from the dataloader, the loss wants int64
+            loss = FusedLinearCrossEntropy.apply(x.view(-1, x.size(-1)), self.lm_head.weight, targets.view(-1).long(), 8192)
+        elif last_token_only:
+            logits = self.lm_head(x[:, [-1], :]) # (B, 1, vocab_size), skips the other T-1 projections
+        else:
+            logits = self.lm_head(x) # (B, T, vocab_size)
+        if use_cache:
+            return logits, loss, present_kv
         return logits, loss
 
 
@@ -188,6 +268,7 @@ class GPT(nn.Module):
 
     def configure_optimizers(self, weight_decay, learning_rate, device):
         # start with all of the candidate parameters (that requires grad)
+        # named_parameters() yields a shared Parameter only once, so the tied wte / lm_head weight is decayed once
         param_dict = {pn: p for pn, p in self.named_parameters()}
         param_dict = {pn: p for pn, p in param_dict.items() if p.requires_grad}
         # create optim groups, Any parameters that is 2D will be weighted decayed, otherwise no.
@@ -202,27 +283,26 @@ class GPT(nn.Module):
         num_nodecay_params = sum(p.numel() for p in nodecay_params)
         print(f"num decayed parameter tensors: {len(decay_params)}, with {num_decay_params:,} parameters")
         print(f"num non-decayed parameter tensors: {len(nodecay_params)}, with {num_nodecay_params:,} parameters")
-        # Created Adamw optimizer and use the fused version if it is available 
-        fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
-        use_fused = fused_available and 'cuda' in device
+        # Created Adamw optimizer, fused (a single kernel for all the parameters) on CUDA, the multi-tensor foreach version otherwise
+        use_fused = 'cuda' in str(device)
         print(f"using fused AdamW: {use_fused}")
-        optimizer = torch.optim.AdamW(optim_groups, lr = learning_rate, betas=(0.9, 0.95), eps= 1e-8, fused=use_fused)
+        optimizer = torch.optim.AdamW(optim_groups, lr = learning_rate, betas=(0.9, 0.95), eps= 1e-8, fused=use_fused, foreach=not use_fused)
         return optimizer    
 # ------------------------------------------------------------------------------------------
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 num_return_sequences = 5
 max_length = 30
 # prefix tokens
-from helloswag import render_example
+from helloswag import render_example, iterate_examples
 import tiktoken
 import numpy as np
 from numpy import split
 
 
 def load_tokens(filename):
-    npt = np.load(filename)
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
+    # memory-map the uint16 shard instead of reading it, only the pages touched by next_batch become resident
+    npt = np.load(filename, mmap_mode='r')
+    return npt
 
 class DataLoaderLite:
     def __init__(self, B, T, process_rank, num_processes):
@@ -252,7 +332,9 @@ class DataLoaderLite:
 
     def next_batch(self):
         B, T = self.B, self.T
-        buf = self.tokens[self.current_position : self.current_position + B * T + 1]
+        # read just this window from the memory-mapped shard; int32 instead of int64 halves the bytes copied to the GPU
+        # (torch has limited uint16 support, nn.Embedding takes int32 indices)
+        buf = torch.from_numpy(self.tokens[self.current_position : self.current_position + B * T + 1].astype(np.int32))
         x = (buf[:-1]).view(B, T) # inputs
         y = (buf[1:]).view(B, T) # tragets
 
@@ -263,12 +345,48 @@ class DataLoaderLite:
             self.current_shard = (self.current_shard + 1) % len(self.shards) # move to the next shard
             self.tokens = load_tokens(self.shards[self.current_shard]) # load the next shard
             self.current_position = self.B * self.T * self.process_rank
+        if torch.cuda.is_available():
+            # page-locked memory lets the host to device copy run asynchronously (non_blocking=True)
+            x, y = x.pin_memory(), y.pin_memory()
         return x, y
+
+def prefetch_batches(loader, device):
+    # yields (x, y) already on device, the copy of the next batch is issued on a side stream
+    # so that it overlaps with the compute of the current micro step
+    stream = torch.cuda.Stream() if 'cuda' in device else None
+    def load():
+        x, y = loader.next_batch()
+        if stream is None:
+            return x.to(device), y.to(device)
+        with torch.cuda.stream(stream):
+            return x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+    next_xy = load()
+    while True:
+        x, y = next_xy
+        if stream is not None:
+            torch.cuda.current_stream().wait_stream(stream) # the copy must be finished before the model reads x, y
+            x.record_stream(torch.cuda.current_stream())
+            y.record_stream(torch.cuda.current_stream())
+        next_xy = load()
+        yield x, y
     
 # -----------------------------------------------------------------------------
-# helper function for HellaSwag eval
-# takes tokens, mask, and logits, returns the index of the completion with the lowest loss
-
+# helper functions for HellaSwag eval
+# examples are evaluated in batches: the 4 completions of N examples are stacked into (N*4, T) rows
+
+def collate_examples(rendered):
+    # takes a list of render_example outputs, pads their (4, T_i) tokens and mask to the longest example
+    # padding is on the right with mask 0, so it is causally invisible and left out of the completion loss
+    max_len = max(tokens.size(1) for _, tokens, _, _ in rendered)
+    tokens = torch.zeros((4 * len(rendered), max_len), dtype=torch.long)
+    mask = torch.zeros((4 * len(rendered), max_len), dtype=torch.long)
+    for i, (_, ex_tokens, ex_mask, _) in enumerate(rendered):
+        tokens[4*i:4*i+4, :ex_tokens.size(1)] = ex_tokens
+        mask[4*i:4*i+4, :ex_mask.size(1)] = ex_mask
+    labels = torch.tensor([label for _, _, _, label in rendered], dtype=torch.long)
+    return tokens, mask, labels
+
+# takes tokens, mask, and logits of N examples, returns for each example the index of the completion with the lowest loss
 def get_most_likely_row(tokens, mask, logits):
     # evaluate the autoregressive loss at all positions
     shift_logits = (logits[..., :-1, :]).contiguous()
@@ -283,9 +401,9 @@ def get_most_likely_row(tokens, mask, logits):
     # sum and divide by the number of 1s in the mask
     sum_loss = masked_shift_losses.sum(dim=1)
     avg_loss = sum_loss / shift_mask.sum(dim=1)
-    # now we have a loss for each of the 4 completions
+    # now we have a loss for each of the 4 completions of every example
     # the one with the lowest loss should be the most likely
-    pred_norm = avg_loss.argmin().item()
+    pred_norm = avg_loss.view(-1, 4).argmin(dim=1) # (N,)
     return pred_norm
     
 # ------------------------------------------------------------------------------------------
@@ -332,6 +450,10 @@ else:
 torch.manual_seed(1337)
 if torch.cuda.is_available():
     torch.cuda.manual_seed(1337)
+# TF32 tensor cores for any matmul / cuDNN op left in fp32, and let cuDNN autotune once for the fixed (B, T, C) shapes
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
 
 total_batch_size = 524288 # 2 **19, ~0.5M, in number of tokens
 B = 64 # micro batch size
@@ -352,16 +474,29 @@ torch.set_float32_matmul_precision('high')
 # create the model
 model = GPT(GPTConfig(vocab_size=50304))
 #model = GPT.from_pretrained("gpt2") # load the pretrained weights from huggingface or init from OpenAI GPT-2
+# on Hopper (H100) swap the Linear layers for FP8 (E4M3) ones, has to happen before torch.compile
+# lm_head is skipped: it is tied to wte and quantizing the classifier costs the most perplexity
+use_fp8 = True # set False to always train the Linear layers in bf16
+if use_fp8 and torch.cuda.is_available() and torch.cuda.get_device_capability() >= (9, 0):
+    try:
+        # optional dependency, not in requirements.txt: pip install torchao
+        from torchao.float8 import convert_to_float8_training
+    except ImportError:
+        convert_to_float8_training = None
+        if master_process:
+            print("torchao is not installed, training the Linear layers in bf16")
+    if convert_to_float8_training is not None:
+        # dynamic scaling (the default) computes the scales from the current amax, no per step amax/scale history sync
+        convert_to_float8_training(model, module_filter_fn=lambda mod, fqn: fqn != "lm_head")
 model.to(device)
+raw_model = model # always contains the "raw" uncompiled and unwrapped model, used for Helloswag eval and Generation
 
-use_compile = False # torch.compile interference with Helloswag eval and Generation, TODO fix
+use_compile = True # only the training step is compiled, Helloswag eval and Generation run on raw_model
 if use_compile:
-    #model = torch.compile(model, mode="reduce-overhead", fullgraph=True)
-    model = torch.compile(model) # 2x speedup on MPS and CUDA, 1.5x on CPU
+    model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False) # 2x speedup on MPS and CUDA, 1.5x on CPU
 
 if ddp:
     model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model
 
 
 max_lr = 6e-4
@@ -390,6 +525,7 @@ os.makedirs(log_dir, exist_ok=True)
 log_file = os.path.join(log_dir, f"log.txt")
 with open(log_file, "w") as f:
     pass
+train_batches = prefetch_batches(train_loader, device)
 
 for step in range(max_steps):
     t0 = time.time()
@@ -403,7 +539,7 @@ for step in range(max_steps):
             val_loss_steps = 20
             for _ in range(val_loss_steps):
                 x, y = val_loader.next_batch()
-                x, y = x.to(device), y.to(device)
+                x, y = x.to(device, non_blocking=True), y.to(device, non_blocking=True)
                 with torch.autocast(device_type = device, dtype=torch.bfloat16):
                     logits, loss = model(x, y)
                 loss = loss / val_loss_steps # scale the loss by the number of micro steps
@@ -429,21 +565,21 @@ for step in range(max_steps):
                 torch.save(checkpoint, checkpoint_path)
 
     # once in a while evaluate helloswag
-    if (step % 250 == 0 or last_step) and (not use_compile):
-        num_currect_norm = 0
+    if step % 250 == 0 or last_step:
+        num_correct_norm = 0
         num_total = 0
-        for i, example in enumerate(val_loader.iterate_examples("val")):
-            if i % ddp_world_size != ddp_rank:
-                continue
-            _, tokens, mask, label = render_example(example)
-            tokens = tokens.to(device)
-            mask = mask.to(device)
+        hella_batch_size = 16 # examples per forward, i.e. 16 * 4 = 64 rows, one example at a time is launch bound
+        examples = [example for i, example in enumerate(iterate_examples("val")) if i % ddp_world_size == ddp_rank]
+        for start in range(0, len(examples), hella_batch_size):
+            rendered = [render_example(example) for example in examples[start:start + hella_batch_size]]
+            tokens, mask, labels = collate_examples(rendered)
+            tokens, mask, labels = tokens.to(device), mask.to(device), labels.to(device)
             with torch.no_grad():
-                with torch.autocast(device_typr=device, dtype=torch.bfloat16):
-                    logits, loss = model(tokens)
+                with torch.autocast(device_type=device, dtype=torch.bfloat16):
+                    logits, loss = raw_model(tokens)
                 pred_norm = get_most_likely_row(tokens, mask, logits)
-                num_total += 1
-                num_correct_norm += int(pred_norm == label)
+                num_total += len(rendered)
+                num_correct_norm += (pred_norm == labels).sum().item()
         if ddp:
             num_total = torch.tensor(num_total, dtype=torch.long, device=device)
             num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=device)
@@ -458,22 +594,27 @@ for step in range(max_steps):
                 f.write(f"{step} hella {acc_norm:.4f}\n")
                 
     # once in a while generate from the model (except step 0, which is noise)
-    if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile):
-        model.eval()
+    if (step > 0 and step % 250 == 0) or last_step:
+        raw_model.eval()
         num_return_sequences = 4
         max_length = 32
         enc = tiktoken.get_encoding('gpt2')
         tokens = enc.encode("Hello, I.m a language model,")
         tokens = torch.tensor(tokens, dtype=torch.long)
         tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
-        xgen = tokens.to(device)
+        # preallocate the whole output once and write each sampled token in place, instead of a torch.cat per step
+        xgen = torch.zeros((num_return_sequences, max_length), dtype=torch.long, device=device)
+        xgen[:, :tokens.size(1)] = tokens
+        cur_len = tokens.size(1)
         sample_rng = torch.Generator(device=device)
         sample_rng.manual_seed(42 + ddp_rank)
-        while xgen.size(1) < max_length:
+        past_kv = None
+        while cur_len < max_length:
             with torch.no_grad():
                 with torch.autocast(device_type=device, dtype=torch.bfloat16):
-                    # take the logits at the last position: (B, vocab_size)
-                    logits, loss = model(xgen) # (B, T, vocab_size)
+                    # the first step forwards the whole prompt, after that only the newest token, the rest is in the kv cache
+                    idx = xgen[:, :cur_len] if past_kv is None else xgen[:, cur_len-1:cur_len]
+                    logits, loss, past_kv = raw_model(idx, last_token_only=True, past_kv=past_kv, use_cache=True) # (B, 1, vocab_size)
                     # take the logits at the last postion
                     logits = logits[:, -1, :]   # (B, vocab_size)
                     # get the probabilities
@@ -487,7 +628,8 @@ for step in range(max_steps):
                     # gather the corresponding indices
                     xcol = torch.gather(topk_indices, -1, ix)
                     # append to the sequence
-                    xgen = torch.cat((xgen, xcol), dim=1)
+                    xgen[:, cur_len:cur_len+1] = xcol
+                    cur_len += 1
         # print the generated sequences
         for i in range(num_return_sequences):
             tokens = xgen[i, :max_length].tolist()
@@ -497,22 +639,21 @@ for step in range(max_steps):
     # training loop
     model.train()
     optimizer.zero_grad()
-    loss_accum = 0.0
+    loss_accum = torch.zeros((), device=device) # accumulated on the GPU, only read back with .item() when logging
     for micro_step in range(grad_accum_steps):
-        x, y = train_loader.next_batch()
-        x, y = x.to(device), y.to(device)
-        with torch.autocast(device_type = device, dtype=torch.bfloat16):
-            logits, loss = model(x, y)
-        # we have to scale the loss to account for gradient accumulation,
-        # because the gradients just add on each succesive backward(),
-        # addition of gradients corresponds to a SUM in the objective, but
-        # instead of a SUM we want Mean, Scale the loss here so it comes out to the same
-        loss = loss / grad_accum_steps # scale the loss by the number of micro steps
-        loss_accum += loss.detach()
-        if ddp:
-            model.required_backward_grad_sync = (micro_step == grad_accum_steps - 1) # sync gradients only on the last micro step to be True
-
-        loss.backward()
+        x, y = next(train_batches)
+        # DDP all-reduces the gradients on every backward(), skip it with no_sync() on all but the last micro step
+        sync_ctx = contextlib.nullcontext() if (not ddp or micro_step == grad_accum_steps - 1) else model.no_sync()
+        with sync_ctx:
+            with torch.autocast(device_type = device, dtype=torch.bfloat16):
+                logits, loss = model(x, y)
+            # we have to scale the loss to account for gradient accumulation,
+            # because the gradients just add on each succesive backward(),
+            # addition of gradients corresponds to a SUM in the objective, but
+            # instead of a SUM we want Mean, Scale the loss here so it comes out to the same
+            loss = loss / grad_accum_steps # scale the loss by the number of micro steps
+            loss_accum += loss.detach()
+            loss.backward()
     if ddp:
         dist.all_reduce(loss_accum, op = dist.ReduceOp.AVG)
     norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0) # gradient clipping
@@ -527,9 +668,10 @@ for step in range(max_steps):
     tokens_per_second = train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
     tokens_per_sec = tokens_per_second / dt 
     if master_process:
-        print(f"step {step:.4f} | loss: {loss_accum.item():.6f} | lr: {lr:.4e} | norm: {norm:.4f} | dt: {dt:.2f}ms | token_per_sec: {tokens_per_sec: .2f}") # loss is a tensor with a single element and it lives on the GPU
+        loss_value = loss_accum.item() # loss is a tensor with a single element and it lives on the GPU
+        print(f"step {step:.4f} | loss: {loss_value:.6f} | lr: {lr:.4e} | norm: {norm:.4f} | dt: {dt:.2f}ms | token_per_sec: {tokens_per_sec: .2f}")
         with open(log_file, "a") as f:
-            f.write(f"{step} train {loss_accum.item():.f6}\n")
+            f.write(f"{step} train {loss_value:.6f}\n")
 if ddp:
     destroy_process_group()
 
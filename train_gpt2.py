@@ -3,9 +3,20 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 import math
+import time
+import functools
+try:
+    import xformers.ops as xops # optional, fused attention kernel for when SDPA is turned off
+except ImportError:
+    xops = None
 
 # ------------------------------------------------------------------------------------------
 
+@functools.lru_cache(maxsize=None)
+def causal_mask(block_size, device):
+    # one bool lower triangular mask per device, shared by all the attention layers instead of a copy in each
+    return torch.tril(torch.ones(block_size, block_size, dtype=torch.bool, device=device)).view(1, 1, block_size, block_size)
+
 class CasualSelfAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -17,35 +28,56 @@ class CasualSelfAttention(nn.Module):
         # regularization
         self.n_head = config.n_head
         self.n_embd = config.n_embd
-        # not really a 'bias', more of a mask, but following the OpenAI/HF naming through
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size,
-         config.block_size)).view(1, 1,config.block_size, config.block_size))
+        self.block_size = config.block_size
+        self.use_sdpa = config.use_sdpa
+        # SDPA with is_causal=True and xformers' LowerTriangularMask apply the mask inside the kernel,
+        # only the eager fallback needs an explicit causal mask, the shared one from causal_mask()
         
-    def forward(self, x):
+    def forward(self, x, past_kv=None, use_cache=False):
+        # past_kv: (k, v) of the previous positions, x then only holds the new token
+        # use_cache: also return the (k, v) of all positions so far, for the next generation step
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
         # calculate query, key, values for all heads in batch and move head forward to br the batch dim
         # nh is "number pf heads", he is "head size", and C (number of channels) = nh * hs
         # e,g. in GPT-2 (124M), n_head=12, hs=64, so nh*hs = c = 768 channels in the Transformer
-        qkv = self.c_attn(x)
-        q, k, v = qkv.split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1))) # (B, nh, T, hs)
-        # attention (materializes thhe large (T, T) matrix for all the queries and keys)
-        att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        y = att @ v # (B, nh, T, T) * (B, nh, T, hs) -> (B, nh, T, hs)
-        y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
+        # a single view + permute instead of split and three separate view/transpose
+        qkv = self.c_attn(x).view(B, T, 3, self.n_head, C // self.n_head)
+        q, k, v = qkv.permute(2, 0, 3, 1, 4).unbind(0) # each (B, nh, T, hs)
+        if past_kv is not None:
+            assert T == 1, "with a kv cache only the newest token is forwarded"
+            past_k, past_v = past_kv
+            k = torch.cat((past_k, k), dim=2) # (B, nh, T_past + 1, hs)
+            v = torch.cat((past_v, v), dim=2)
+        # a single new query may attend to every cached position, so it needs no causal mask
+        if self.use_sdpa:
+            # Flash attention (does not materialize the large (T, T) matrix for all the queries and keys)
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0.0, is_causal=past_kv is None) # (B, nh, T, hs)
+        elif xops is not None:
+            # xformers: mask, softmax and the weighted sum in one kernel with an online softmax, takes (B, T, nh, hs)
+            attn_bias = xops.LowerTriangularMask() if past_kv is None else None
+            y = xops.memory_efficient_attention(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2), attn_bias=attn_bias)
+            y = y.transpose(1, 2) # (B, nh, T, hs)
+        else:
+            # eager attention (materializes thhe large (T, T) matrix for all the queries and keys)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1))) # (B, nh, T, T)
+            if past_kv is None:
+                att = att.masked_fill(~causal_mask(self.block_size, x.device)[:,:,:T,:T], float('-inf'))
+            att = F.softmax(att, dim=-1)
+            y = att @ v # (B, nh, T, T) * (B, nh, T, hs) -> (B, nh, T, hs)
+        # q, k, v are (B, nh, T, hs) views of (B, T, nh, hs) memory, and SDPA's flash / memory-efficient kernels
+        # (and xformers) write y in that same layout, so after the transpose reshape is a view instead of a copy
+        y = y.transpose(1, 2).reshape(B, T, C) # re-assemble all head outputs side by side
         # output projection                     
         y = self.c_proj(y)
+        if use_cache:
+            return y, (k, v)
         return y
 
 class MLP(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.c_fc = nn.Linear(config.n_embd, 4 * config.n_embd)
-        self.gelu = nn.GELU() # gelu non-linear activation function
+        self.gelu = nn.GELU(approximate='tanh') # gelu non-linear activation function, tanh approximation like GPT-2 / HF
         self.c_proj = nn.Linear(4 * config.n_embd, config.n_embd)
 
     def forward(self, x):
@@ -62,18 +94,26 @@ class Block(nn.Module):
         self.ln_2 = nn.LayerNorm(config.n_embd)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x)) # Residual connection:  attention is a communication operation it is where all thr 1024 tokens lined up in a sequence and this is where the tokens communicate, this is where they talk to each other and exchange information so attention is aggergation function, pooling function it's a weighted sum function and it is a reduced operation
+    def forward(self, x, past_kv=None, use_cache=False):
+        attn_out = self.attn(self.ln_1(x), past_kv=past_kv, use_cache=use_cache)
+        if use_cache:
+            attn_out, present_kv = attn_out
+        # no hand-fused add + LayerNorm here: the model is run through torch.compile, where inductor already fuses
+        # every residual add with the LayerNorm that follows it (ln_2 here, the next block's ln_1 / ln_f after the mlp)
+        x = x + attn_out # Residual connection:  attention is a communication operation it is where all thr 1024 tokens lined up in a sequence and this is where the tokens communicate, this is where they talk to each other and exchange information so attention is aggergation function, pooling function it's a weighted sum function and it is a reduced operation
         x = x + self.mlp(self.ln_2(x)) # Map connection:  MLP is a feedforward neural network it is a non-linear function, it is a transformation function. It happens every single token individually, there is no information being collected or exchanges between the tokens, so the attention is reduced and mlp is the map 
+        if use_cache:
+            return x, present_kv
         return x
 
 @dataclass
 class GPTConfig:
     block_size: int = 1024 # max sequence length
-    vocab_size: int = 50257 # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <endoftext> token
+    vocab_size: int = 50304 # number of tokens: 50,000 BPE merges + 256 bytes tokens + 1 <endoftext> token = 50257, padded to a multiple of 64 for the tensor cores
     n_layer: int = 12 # number of transformer layers
     n_head: int = 12 # number of heads
     n_embd: int = 768 # embedding dimension
+    use_sdpa: bool = True # F.scaled_dot_product_attention, set False to debug or on older GPUs (uses xformers if installed)
 
 class GPT(nn.Module):
     def __init__(self, config):
@@ -83,34 +123,57 @@ class GPT(nn.Module):
         self.transformer = nn.ModuleDict(dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.Sequential(*[Block(config) for _ in range(config.n_layer)]), # same h.0, h.1, ... keys as a ModuleList
             ln_f = nn.LayerNorm(config.n_embd),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)  
 
-    def forward(self, idx):
+        # weigth sharing scheme, the classifier reuses the token embedding matrix as in the original GPT-2
+        self.lm_head.weight = self.transformer.wte.weight
+        # position indices built once and sliced in forward, moves with model.to(device), not saved in the state dict
+        self.register_buffer("pos_ids", torch.arange(config.block_size, dtype=torch.long), persistent=False)
+
+    def forward(self, idx, targets=None, past_kv=None, use_cache=False):
         # idx is of shape (B, T) where B is batch size and T is the sequence length
+        # past_kv / use_cache: kv cache for generation, a list with the (k, v) of every layer,
+        # with use_cache=True the updated cache is returned as a third output
         B, T = idx.size()
-        assert T <= self.config.block_size, f"Cannot forward sequence lenght {T}, block size is {self.config.block_size}"
+        past_len = past_kv[0][0].size(2) if past_kv is not None else 0
+        assert past_len + T <= self.config.block_size, f"Cannot forward sequence lenght {past_len + T}, block size is {self.config.block_size}"
         # forward the GPT model tokens and position embeddings
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # shape (T)
+        pos = self.pos_ids[past_len:past_len + T] # shape (T)
         pos_emb = self.transformer.wpe(pos) # postion embedding of shape (T, n_embd)
         tok_emb = self.transformer.wte(idx) # token embedding of shape (B, T, n_embd)
         x = tok_emb + pos_emb # sum token and position embedding
         # forward the block of the transformer
-        for block in self.transformer.h:
-            x = block(x)
+        if use_cache:
+            # generation threads the kv cache of every layer, so the blocks are stepped one by one
+            present_kv = []
+            for i, block in enumerate(self.transformer.h):
+                x, kv = block(x, past_kv=past_kv[i] if past_kv is not None else None, use_cache=True)
+                present_kv.append(kv)
+        else:
+            x = self.transformer.h(x) # a single call site that torch.compile inlines, no Python loop per layer
         # forward the final layernorm and the classifier
         x = self.transformer.ln_f(x) 
         logits = self.lm_head(x) # (B, T, vocab_size)
-        return logits
+        loss = None
+        if targets is not None:
+            # only the 50257 real tokens go into the softmax, the padded columns (tied to the zero wte rows)
+            # would otherwise add spurious classes with logit 0 to every position
+            loss = F.cross_entropy(logits[..., :50257].reshape(-1, 50257), targets.view(-1))
+        if use_cache:
+            return logits, loss, present_kv
+        return logits, loss
 
 
     @classmethod
     def from_pretrained(cls, model_type):
         """Loads pretrained GPT-2 model weights from huggingface"""
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
-        from transformers import GPT2LMHeadModel
+        from huggingface_hub import hf_hub_download
+        from safetensors.torch import load_file
+        from concurrent.futures import ThreadPoolExecutor
         print("loading weights from pretrained gpt: %s" % model_type)
 
         # n_layer, n_head and n_embd are determined from model_type
@@ -120,68 +183,153 @@ class GPT(nn.Module):
             'gpt2-large': dict(n_layer=36, n_head=20, n_embd=1280), # 774M parameters
             'gpt2-xl': dict(n_layer=48, n_head=25, n_embd=1600), # 1558M parameters
         }[model_type]
-        config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
+        config_args['vocab_size'] = 50304 # the checkpoints have 50257 tokens, padded up to a tensor core friendly 50304
         config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
         # create a from-scratch initialized minGPT model
         config = GPTConfig(**config_args)
         model = GPT(config)
         sd = model.state_dict()
         sd_keys = sd.keys()
-        sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer key and used for autorergressive mask
+        sd_keys = [k for k in sd_keys if k != 'lm_head.weight'] # tied to transformer.wte.weight, copied through that key
 
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
+        # read the checkpoint tensors straight from the (memory-mapped) safetensors file of the huggingface hub,
+        # instead of building a whole GPT2LMHeadModel just to take its state_dict
+        path = hf_hub_download(model_type, "model.safetensors")
+        sd_hf = load_file(path, device='cpu')
+        # the file holds the GPT2Model weights without the "transformer." prefix (and no lm_head, it is tied to wte)
+        sd_hf = {k if k.startswith('transformer.') else f'transformer.{k}': v for k, v in sd_hf.items()}
 
         # copy while ensuring all of the parameters are aligned and match in name and shapes
         sd_keys_hf = sd_hf.keys()
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignored these, just a buffer
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same just the mask (buffer)
+        sd_keys_hf = [k for k in sd_keys_hf if k != 'lm_head.weight'] # tied in the checkpoint as well, same tensor as wte
         transposed = ['attn.c_attn.weight', 'attn.c_proj.weight', 'mlp.c_fc.weight', 'mlp.c_proj.weight']
         # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
         # this means that we have to transpose these weights when we import them
         assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
-        for k in sd_keys_hf:
+        def source_tensor(k):
             if any(k.endswith(x) for x in transposed):
                 # special treatment for the Conv1D weights we need to transpose
                 assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
+                return sd_hf[k].t().contiguous()
+            elif k == 'transformer.wte.weight':
+                # the padded vocab rows (50257 -> 50304) are never a target, they start at zero
+                assert sd_hf[k].shape[1] == sd[k].shape[1]
+                return F.pad(sd_hf[k], (0, 0, 0, sd[k].size(0) - sd_hf[k].size(0)))
             else:
                 # vanilla copy over the other parameters
                 assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
+                return sd_hf[k]
+        # the strided transpose copies run in a thread pool, torch releases the GIL inside them
+        with ThreadPoolExecutor() as pool:
+            srcs = list(pool.map(source_tensor, sd_keys_hf))
+        dsts = [sd[k] for k in sd_keys_hf]
+        # one batched copy of all the tensors instead of a copy_ call per parameter
+        with torch.no_grad():
+            torch._foreach_copy_(dsts, srcs)
         return model
     
+# ------------------------------------------------------------------------------------------
+import tiktoken
+
+class DataLoaderLite:
+    def __init__(self, B, T):
+        self.B = B
+        self.T = T
+
+        with open('input.txt', 'r') as f:
+            text = f.read()
+        enc = tiktoken.get_encoding('gpt2')
+        tokens = enc.encode(text)
+        self.tokens = torch.tensor(tokens)
+        print(f'loaded {len(self.tokens)} tokens')
+        print(f"1 epoch = {len(self.tokens) // (B * T)} batches")
+
+        #state
+        self.current_position = 0
+
+    def next_batch(self):
+        B, T = self.B, self.T
+        buf = self.tokens[self.current_position : self.current_position + B * T + 1]
+        x = (buf[:-1]).view(B, T) # inputs
+        y = (buf[1:]).view(B, T) # tragets
+
+        # advance the position in the tensor
+        self.current_position += B * T
+        # if loading the next batch would be out of bounds, reset the position
+        if self.current_position + (B * T + 1) > len(self.tokens):
+            self.current_position = 0
+        if torch.cuda.is_available():
+            # page-locked memory so the host to device copy can be asynchronous (non_blocking=True)
+            x, y = x.pin_memory(), y.pin_memory()
+        return x, y
+
+def prefetch_batches(loader, device):
+    # yields (x, y) already on device, the copy of the next batch is issued on a side stream
+    # so that it overlaps with the compute of the current step
+    stream = torch.cuda.Stream() if device.type == 'cuda' else None
+    def load():
+        x, y = loader.next_batch()
+        if stream is None:
+            return x.to(device), y.to(device)
+        with torch.cuda.stream(stream):
+            return x.to(device, non_blocking=True), y.to(device, non_blocking=True)
+    next_xy = load()
+    while True:
+        x, y = next_xy
+        if stream is not None:
+            torch.cuda.current_stream().wait_stream(stream) # the copy must be finished before the model reads x, y
+            x.record_stream(torch.cuda.current_stream())
+            y.record_stream(torch.cuda.current_stream())
+        next_xy = load()
+        yield x, y
+
 # ------------------------------------------------------------------------------------------
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 num_return_sequences = 5
 max_length = 30
+# use TF32 tensor cores for the fp32 matmuls (c_attn, c_fc, c_proj, lm_head) instead of strict fp32
+torch.set_float32_matmul_precision('high')
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 model = GPT.from_pretrained('gpt2')
 # model = GPT(GPTConfig())
 model.eval()
 model.to(device)
+raw_model = model # the uncompiled model, shared by the training and the generation compile below
+# fuse the LayerNorm/Linear/GELU/residual chains and replay CUDA graphs, the training batches are always (4, 32)
+# so a single static graph is recorded
+model = torch.compile(raw_model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+# generation changes the prompt and kv cache length every step, with reduce-overhead every new shape records
+# another CUDA graph, so it only gets the kernel fusion (dynamic=True, no recompile per length)
+gen_model = torch.compile(raw_model, dynamic=True)
 #print(model)
 
 # prefix tokens
-import tiktoken
 enc = tiktoken.get_encoding('gpt2')
 tokens = enc.encode("Hello, I'm a language model,")
 tokens = torch.tensor(tokens, dtype=torch.long) #(8, )
 tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1) #(5, 8)
-x = tokens.to(device)
+# allocate the whole generation output once, sampled tokens are written in place instead of a torch.cat per step
+out = torch.full((num_return_sequences, max_length), enc.eot_token, dtype=torch.long, device=device) #(5, 30)
+out[:, :tokens.size(1)] = tokens
+cur_len = tokens.size(1)
 #print(tokens)
 
+train_loader = DataLoaderLite(B=4, T=32)
+
 # optimize!
-optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8)
+# fused AdamW updates all the parameters in a single kernel on CUDA, the multi-tensor foreach version is the fallback
+use_fused = device.type == 'cuda'
+optimizer = torch.optim.AdamW(model.parameters(), lr=3e-4, betas=(0.9, 0.95), eps=1e-8, fused=use_fused, foreach=not use_fused)
+train_batches = prefetch_batches(train_loader, device)
 for i in range(50):
     t0 = time.time()
-    x, y = train_loader.next_batch()
-    x, y = x.to(device), y.to(device)
-    optimizer.zero_grad()
+    optimizer.zero_grad(set_to_none=True) # drop the grads instead of launching a zeroing kernel per parameter
+    x, y = next(train_batches)
 
-    with torch.autocast(device_type = device, dtype=torch.bfloat16):
+    with torch.autocast(device_type = device.type, dtype=torch.bfloat16):
         logits, loss = model(x, y)
     loss.backward()
     norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0) # gradient clipping
@@ -193,30 +341,36 @@ for i in range(50):
     print(f"step {i} | loss: {loss.item()} | norm: {norm:.4f} | dt: {dt:.2f}ms | token_per_second: {tokens_per_second: .2f}") # loss is a tensor with a single element and it lives on the GPU
 
 
-# generate! right now x is (B, T)  where B=5, T=8
+# generate! right now out[:, :cur_len] is (B, T)  where B=5, T=8
 # set the seed to 42
 torch.manual_seed(42)
 torch.cuda.manual_seed(42)
-while x.size(1) < max_length:
+past_kv = None
+while cur_len < max_length:
     # forward the model to get the logits
-    with torch.no_grad():
-        logits = model(x) # (B, T, vocab_size)
+    with torch.no_grad(), torch.autocast(device_type=device.type, dtype=torch.bfloat16): # bf16 like the training step
+        # the first step forwards the whole prompt, after that only the newest token, the rest is in the kv cache
+        idx = out[:, :cur_len] if past_kv is None else out[:, cur_len-1:cur_len]
+        logits, _, past_kv = gen_model(idx, past_kv=past_kv, use_cache=True) # (B, T, vocab_size)
         # take the logits at the last position: (B, vocab_size)
-        logits = logits[:, -1, :] # (B, vocab_size)
+        logits = logits[:, -1, :enc.n_vocab] # (B, vocab_size), without the padded tokens
         # get the probabilities
         probs = F.softmax(logits, dim=-1)
         # do top-k sampling of 50 (hugging face pipeline default)
         # topk_probs here becomes (5, 50), topk_indices is (5, 50)
         topk_probs, topk_indices = torch.topk(probs, 50, dim=-1)
-        # select a token from the top-k probabilities
-        ix = torch.multinomial(topk_probs, 1) # (B, 1)
+        # select a token from the top-k probabilities with the Gumbel-max trick: argmax(log p + Gumbel noise)
+        # samples from p like torch.multinomial, but is only elementwise ops + argmax, no sync and CUDA graph friendly
+        gumbel = -torch.log(-torch.log(torch.rand_like(topk_probs).clamp_min(1e-20)))
+        ix = (topk_probs.log() + gumbel).argmax(dim=-1, keepdim=True) # (B, 1)
         # gather the corresponding indices
         xcol = torch.gather(topk_indices, -1, ix) # (B, 1)
         # append to the sequence
-        x = torch.cat((x, xcol), dim=1)
+        out[:, cur_len:cur_len+1] = xcol
+        cur_len += 1
 
 # print the generated sequences       
 for i in range(num_return_sequences):
-    tokens = x[i, :max_length].tolist()
+    tokens = out[i, :max_length].tolist()
     decode = enc.decode(tokens)
     print(">", decode)
\ No newline at end of file